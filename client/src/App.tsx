@@ -25,6 +25,12 @@ type ChatMsg = { from: string; text: string; ts: number; timeString: string; };
 // Group: stored group object returned from server
 type Group = { gid: string; name: string; members: string[] };
 
+// HistoryCursor: position of the oldest loaded message, sent back to fetch older ones
+type HistoryCursor = { ts: number; id: number };
+
+// HistoryPage: one page of chat history returned by fetch_history
+type HistoryPage = { messages: any[]; has_more: boolean; cursor: HistoryCursor | null };
+
 
 function App() {
   // ==========================================================
@@ -49,6 +55,12 @@ function App() {
   // chatHistory: stores messages for currently opened chat
   const [chatHistory, setChatHistory] = useState<ChatMsg[]>([]);
 
+  // hasMoreHistory: whether the server has older messages than the ones loaded
+  const [hasMoreHistory, setHasMoreHistory] = useState(false);
+
+  // historyCursor: where the next older page starts
+  const [historyCursor, setHistoryCursor] = useState<HistoryCursor | null>(null);
+
   // message: current text typed in chat input
   const [message, setMessage] = useState('');
 
@@ -70,6 +82,9 @@ function App() {
   // chatContainerRef: reference to chat div to auto-scroll on new messages
   const chatContainerRef = useRef<HTMLDivElement | null>(null);
 
+  // sessionToken: token from the last successful login, used to log back in on reconnect
+  const sessionToken = useRef<string | null>(null);
+
   // ==========================================================
   // Auto-scroll behavior for chat messages
   // ==========================================================
@@ -83,21 +98,26 @@ function App() {
   // Socket Setup & Incoming Event Listeners
   // ==========================================================
   useEffect(() => {
-    socket.on('connect', () => console.log('Connected'));
-
-    // When receiving a message from server
-    socket.on('receive_message', (data: any) => {
-      const timestamp = data.timestamp || Date.now();
-      const msg: ChatMsg = { 
-        from: data.from, 
-        text: data.text, 
-        ts: timestamp,
-        timeString: formatTime(timestamp)
-      };
-
-      // Only append message to currently active chat
-      if (activeChat && data.targetId === activeChat.id) {
-        setChatHistory((prev) => [...prev, msg]);
+    socket.on('connect', () => {
+      console.log('Connected');
+
+      // After a reconnect the server sees a new socket, so log it back in with our token
+      if (sessionToken.current) {
+        socket.emit('login', { username, password, token: sessionToken.current }, (res: any) => {
+          if (res.status === 'ok') sessionToken.current = res.token;
+        });
+      }
+    });
+
+    // When receiving messages from server (sent in small batches)
+    socket.on('receive_batch', (batch: any[]) => {
+      // Only append messages for the currently active chat
+      const msgs = batch
+        .filter((data) => activeChat && data.targetId === activeChat.id)
+        .map(toChatMsg);
+
+      if (msgs.length > 0) {
+        setChatHistory((prev) => [...prev, ...msgs]);
         setTimeout(scrollToBottom, 50);
       }
     });
@@ -120,11 +140,11 @@ function App() {
     // Cleanup event listeners when component unmounts or dependencies change
     return () => {
       socket.off('connect');
-      socket.off('receive_message');
+      socket.off('receive_batch');
       socket.off('group_created');
       socket.off('member_added');
     };
-  }, [activeChat, username, scrollToBottom]);
+  }, [activeChat, username, password, scrollToBottom]);
 
   // ==========================================================
   // Fetch Chat History when switching chats
@@ -134,21 +154,37 @@ function App() {
 
     // Clear old history
     setChatHistory([]);
-
-    // Request chat history from server
-    socket.emit('fetch_history', { targetType: activeChat.type, targetId: activeChat.id }, (history: any[]) => {
-      const msgs = history.map((m) => ({ 
-        from: m.from, 
-        text: m.text, 
-        ts: m.timestamp || Date.now(),
-        timeString: formatTime(m.timestamp || Date.now())
-      }));
-
-      setChatHistory(msgs);
+    setHasMoreHistory(false);
+    setHistoryCursor(null);
+
+    // Request the latest page of chat history from server
+    socket.emit('fetch_history', { targetType: activeChat.type, targetId: activeChat.id }, (page: HistoryPage) => {
+      setChatHistory(page.messages.map(toChatMsg));
+      setHasMoreHistory(page.has_more);
+      setHistoryCursor(page.cursor);
       setTimeout(scrollToBottom, 50);
     });
   }, [activeChat, scrollToBottom]);
 
+  // ==========================================================
+  // Load older messages (previous history page)
+  // ==========================================================
+  const loadOlderMessages = () => {
+    if (!activeChat || !historyCursor) return;
+
+    const payload = {
+      targetType: activeChat.type,
+      targetId: activeChat.id,
+      before: historyCursor,
+    };
+
+    socket.emit('fetch_history', payload, (page: HistoryPage) => {
+      setChatHistory((prev) => [...page.messages.map(toChatMsg), ...prev]);
+      setHasMoreHistory(page.has_more);
+      setHistoryCursor(page.cursor);
+    });
+  };
+
   // ==========================================================
   // Authentication Actions
   // ==========================================================
@@ -159,6 +195,7 @@ function App() {
     socket.emit('login', { username, password }, (res: any) => {
       if (res.status === 'ok') {
         setIsLoggedIn(true);
+        sessionToken.current = res.token;
 
         // Load users list
         setUsersList(res.users || []);
@@ -195,6 +232,16 @@ function App() {
     return date.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
   };
 
+  // ==========================================================
+  // Utility: Convert a stored message from the server into a ChatMsg
+  // ==========================================================
+  const toChatMsg = (m: any): ChatMsg => ({
+    from: m.from,
+    text: m.text,
+    ts: m.timestamp || Date.now(),
+    timeString: formatTime(m.timestamp || Date.now())
+  });
+
   // ==========================================================
   // Send Message
   // ==========================================================
@@ -424,6 +471,14 @@ function App() {
               className="flex-1 overflow-y-auto p-4 bg-gray-800 rounded-lg flex flex-col gap-3"
               style={{ minHeight: 200 }}
             >
+              {hasMoreHistory && (
+                <button
+                  onClick={loadOlderMessages}
+                  className="self-center bg-gray-700 px-3 py-1 rounded hover:bg-gray-600 text-sm"
+                >
+                  Load older messages
+                </button>
+              )}
               {chatHistory.map((m, i) => {
                 const mine = m.from === username;
                 return (
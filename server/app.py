@@ -1,19 +1,141 @@
+import asyncio
+import engineio
+import logging
+import secrets
+import sys
+import time
+import orjson
 import socketio
 import uvicorn
 from fastapi import FastAPI
-from datetime import datetime
 import db_utils
 
+logger = logging.getLogger(__name__)
+
 # --- Socket.IO + FastAPI setup ---
 
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*') # Create async SocketIO server that runs on ASGI and accepts all CORS origins.
+class OrjsonCodec:
+    # Drop-in for the json module that socket.io uses to encode/decode packets
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', json=OrjsonCodec) # Create async SocketIO server that runs on ASGI and accepts all CORS origins.
+
+# --- Background disk writer ---
+
+writer_task = None
+
+async def disk_writer():
+    # Commits saved messages and writes queued JSON saves in small batches, off the event loop
+    while True:
+        await sio.sleep(db_utils.FLUSH_INTERVAL)
+        # A failed write is logged and retried on the next tick instead of killing the writer
+        try:
+            await db_utils.commit_messages()
+        except Exception:
+            logger.exception("committing messages failed")
+        try:
+            await asyncio.to_thread(db_utils.flush_writes)
+        except Exception:
+            logger.exception("writing JSON saves failed")
+
+async def startup():
+    global writer_task
+    await db_utils.init_db()
+    writer_task = sio.start_background_task(disk_writer)
+
+async def shutdown():
+    # Stop the writer and flush whatever it hadn't picked up yet
+    writer_task.cancel()
+    db_utils.flush_writes()
+    await db_utils.close_db()
+
 app = FastAPI() # Base FastAPI app
-app = socketio.ASGIApp(sio, other_asgi_app=app) # Wrap FastAPI app with Socket.IO’s ASGI adapter so both live together
+app = socketio.ASGIApp(sio, other_asgi_app=app, on_startup=startup, on_shutdown=shutdown) # Wrap FastAPI app with Socket.IO’s ASGI adapter so both live together
 
 # --- Connection state tracking ---
 
 connected_users = {}  # username -> sid (socketio session id)
 sid_to_user = {}      # sid -> username
+session_tokens = {}   # token -> (username, expiry) for tokens handed out at login, oldest first
+
+SESSION_TTL = 24 * 60 * 60  # Seconds a login token can be used to reconnect without the password
+
+# Every logged in socket joins a room for its user and one per group it's in,
+# so fan-out is a single room emit instead of a loop over members.
+def user_room(username):
+    return f"user:{username}"
+
+def group_room(gid):
+    return f"group:{gid}"
+
+# --- Broadcast fast path ---
+
+async def broadcast_prepared(event, payload, room):
+    # `room` can be a single room/sid or a list of them.
+    # Every participant gets an identical packet, so encode the socket.io frame
+    # once ourselves and hand that same engine.io packet to each of them
+    frame = f"{socketio.packet.EVENT}{orjson.dumps([event, payload]).decode()}"
+    pkt = engineio.packet.Packet(engineio.packet.MESSAGE, data=frame)
+
+    # An engine.io send only puts the packet on the socket's queue, so a plain loop is
+    # cheapest; gathering them would just add a task per recipient
+    for _, eio_sid in sio.manager.get_participants('/', room):
+        await sio.eio.send_packet(eio_sid, pkt)
+
+# --- Outgoing message coalescing ---
+
+COALESCE_DELAY = 0.02  # How long queued messages are held so each socket gets them as one batch
+
+# Everything bound for a socket goes into that socket's one batch, whichever room it was
+# sent through, so a chat's messages always reach it in the order they were sent
+pending_batches = {}    # sid -> chat payloads waiting to be flushed, in send order
+flush_tasks = set()     # Running flush_batches() tasks, referenced so they aren't garbage collected
+flush_scheduled = False
+
+def in_room(sid, room):
+    # Room membership is per socket, so a user's older tab may not be in a room their name is
+    return sid in sio.manager.rooms.get('/', {}).get(room, ())
+
+def queue_message(room, payload):
+    global flush_scheduled
+    # socket.io drops a room once its last socket leaves, so a room with nobody online
+    # queues nothing and skips batching and encoding altogether
+    for sid, _ in sio.manager.get_participants('/', room):
+        pending_batches.setdefault(sid, []).append(payload)
+
+    # The first queued message schedules the flush; later ones just join their batches
+    if pending_batches and not flush_scheduled:
+        flush_scheduled = True
+        asyncio.get_running_loop().call_later(COALESCE_DELAY, start_flush)
+
+def start_flush():
+    global pending_batches, flush_scheduled
+    batches, pending_batches = pending_batches, {}
+    flush_scheduled = False
+
+    task = asyncio.ensure_future(flush_batches(batches))
+    flush_tasks.add(task)
+    task.add_done_callback(flush_done)
+
+def flush_done(task):
+    flush_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("delivering a message batch failed", exc_info=task.exception())
+
+async def flush_batches(batches):
+    # Sockets due the exact same payloads, like everyone in a group room, share one encoded packet
+    recipients = {}
+    for sid, batch in batches.items():
+        recipients.setdefault(tuple(map(id, batch)), (batch, []))[1].append(sid)
+
+    for batch, sids in recipients.values():
+        await broadcast_prepared('receive_batch', batch, sids)
 
 # --- Connection lifecycle ---
 
@@ -35,40 +157,74 @@ async def disconnect(sid):
 
 # --- Auth & Initial data ---
 
+def issue_token(u):
+    # Every token lives for the same SESSION_TTL, so expired ones are always at the front
+    now = time.monotonic()
+    while session_tokens:
+        oldest = next(iter(session_tokens))
+        if session_tokens[oldest][1] > now:
+            break
+        del session_tokens[oldest]
+
+    token = secrets.token_urlsafe(32)
+    session_tokens[token] = (u, now + SESSION_TTL)
+    return token
+
+def redeem_token(u, token):
+    # Tokens work once, so one that's seen later can't be replayed after the client used it
+    session = session_tokens.pop(token, None) if isinstance(token, str) else None
+    return session is not None and session[0] == u and session[1] > time.monotonic()
+
+async def check_credentials(u, p):
+    # bcrypt takes ~100ms per call, so hashing runs in the thread pool
+    record = db_utils.get_users().get(u)
+    if record is not None and not await asyncio.to_thread(db_utils.check_password, p, record):
+        return False
+
+    # Auto-register new users, and upgrade old plaintext records to a hash
+    if record is None or isinstance(record, str):
+        password_hash = await asyncio.to_thread(db_utils.hash_password, p)
+        # Someone may have registered this name while we were hashing
+        if record is None and u in db_utils.get_users():
+            return False
+        db_utils.save_user(u, password_hash)
+
+    return True
+
 @sio.event
 async def login(sid, data):
     """
     Simple login. If the user does not exist, we auto register them.
+    Passing back the token from an earlier login skips the password check;
+    each login hands out a fresh one.
     """
-    users = db_utils.get_users()
-    u, p = data.get('username'), data.get('password')
+    u, p = data.get('username'), data.get('password') or ''
+    token = data.get('token')
 
-    # Auto-register if user doesn't exist yet
-    if u not in users:
-        users[u] = p
-        db_utils._save_json(db_utils.USERS_FILE, users)
+    if not isinstance(u, str) or not isinstance(p, str):
+        return {"status": "error", "msg": "Invalid credentials"}
 
-    # Basic password check
-    if users[u] == p:
+    if redeem_token(u, token) or await check_credentials(u, p):
         # Track the connection in both maps
         connected_users[u] = sid
         sid_to_user[sid] = u
 
         # Build initial state for the frontend
         all_users = db_utils.get_user_list_public()
-        all_groups = db_utils.get_groups()
 
         # Only send back groups that this user is actually in
-        my_groups = {
-            gid: g
-            for gid, g in all_groups.items()
-            if u in g['members']
-        }
+        my_groups = db_utils.get_user_groups(u)
+
+        # Join the rooms we broadcast to
+        await sio.enter_room(sid, user_room(u))
+        for gid in my_groups:
+            await sio.enter_room(sid, group_room(gid))
 
         return {
             "status": "ok",
             "users": all_users,
             "groups": my_groups,
+            "token": issue_token(u),
         }
 
     return {"status": "error", "msg": "Invalid credentials"}
@@ -78,13 +234,30 @@ async def login(sid, data):
 @sio.event
 async def fetch_history(sid, data):
     """
-    Fetch message history.
+    Fetch the latest page of message history, or the page before the
+    `before` cursor returned with a previous page.
     """
     user = sid_to_user[sid]
-    history = db_utils.load_history(
+
+    # Page size is capped on both ends, so a client can never ask for the whole history
+    limit = data.get('limit', db_utils.HISTORY_PAGE_SIZE)
+    if not isinstance(limit, int) or isinstance(limit, bool):
+        return {"status": "error", "msg": "Invalid limit"}
+    limit = max(1, min(limit, db_utils.HISTORY_PAGE_SIZE))
+
+    before = data.get('before')
+    if before is not None:
+        ts, msg_id = (before.get('ts'), before.get('id')) if isinstance(before, dict) else (None, None)
+        if not isinstance(ts, (int, float)) or not isinstance(msg_id, int):
+            return {"status": "error", "msg": "Invalid cursor"}
+        before = (ts, msg_id)
+
+    history = await db_utils.load_history(
         data['targetType'],
         user,
-        data['targetId']
+        data['targetId'],
+        limit,
+        before
     )
     return history
 
@@ -101,55 +274,36 @@ async def send_message(sid, data):
     text = data['text']
 
     # Persist the message
-    msg_obj = db_utils.save_message(target_type, sender, target_id, text)
+    msg_obj = await db_utils.save_message(target_type, sender, target_id, text)
 
-    # Common payload for all recipients
+    # Payload for the recipients, built once with its final targetId.
+    # For private chats, we treat the conversation id as the sender and for group chats it'll be the group id.
     response = {
-        # For private chats, we treat the conversation id as the sender and for group chats it'll be the group id.
         "targetId": target_id if target_type == 'group' else sender,
         "from": sender,
         "text": text,
-        "timestamp": msg_obj.get("timestamp", datetime.now().timestamp()),
+        "timestamp": msg_obj["timestamp"],  # save_message always sets it
         "type": target_type,
     }
 
+    # Deliveries are queued per recipient socket and sent as `receive_batch` events after COALESCE_DELAY
     if target_type == 'private':
-        # Echo back to sender
-        await sio.emit(
-            'receive_message',
-            {**response, "targetId": target_id},
-            to=sid
-        )
+        # Echo back to sender, keyed by the user they're talking to
+        echo = {**response, "targetId": target_id}
+        queue_message(sid, echo)
 
         # If other user is online, send it to them as well
-        if target_id in connected_users:
-            await sio.emit(
-                'receive_message',
-                response,
-                to=connected_users[target_id]
-            )
+        queue_message(user_room(target_id), response)
 
     elif target_type == 'group':
-        # We'll need the group members for broadcasting
-        groups = db_utils.get_groups()
-
-        # First, confirm to the sender that their message went through
-        await sio.emit(
-            'receive_message',
-            {**response, "targetId": target_id},
-            to=sid
-        )
+        # The group payload is the same for everyone, so online members (sender included)
+        # all get it through the group room, in the same order
+        if db_utils.get_group_members(target_id):
+            queue_message(group_room(target_id), response)
 
-        # Now fan out to other group members
-        if target_id in groups:
-            for member in groups[target_id]['members']:
-                # Skip sender, we've already sent to them
-                if member in connected_users and member != sender:
-                    await sio.emit(
-                        'receive_message',
-                        {**response, "targetId": target_id},
-                        to=connected_users[member]
-                    )
+        # A socket outside the room doesn't get it that way, but still needs its confirmation
+        if not in_room(sid, group_room(target_id)):
+            queue_message(sid, response)
 
 
 # --- Group management ---
@@ -161,6 +315,7 @@ async def create_new_group(sid, data):
     """
     creator = sid_to_user[sid]
     gid, g_data = db_utils.create_group(data['name'], creator)
+    await sio.enter_room(sid, group_room(gid))
 
     # Let creator know group is ready on the server
     await sio.emit(
@@ -179,32 +334,29 @@ async def add_member(sid, data):
     new_user = data['username']
 
     # If db_utils says the add worked, update everyone who's affected
-    if db_utils.add_member_to_group(gid, new_user):
-        groups = db_utils.get_groups()
-        group = groups[gid]
-
-        # If the newly added user is online, send them the group info
-        if new_user in connected_users:
-            await sio.emit(
-                'group_created',
-                {"gid": gid, "name": group['name'], "members": group['members']},
-                to=connected_users[new_user]
-            )
+    group = db_utils.add_member_to_group(gid, new_user)
+    if group:
+        # If the newly added user is online, join every socket of theirs to the room and send them the group info
+        for member_sid, _ in sio.manager.get_participants('/', user_room(new_user)):
+            await sio.enter_room(member_sid, group_room(gid))
+        await sio.emit(
+            'group_created',
+            {"gid": gid, "name": group['name'], "members": group['members']},
+            room=user_room(new_user)
+        )
 
         # Notify all current group members that someone was added
-        for member in group['members']:
-            if member in connected_users:
-                await sio.emit(
-                    'member_added',
-                    {
-                        "group": {
-                            "gid": gid,
-                            "name": group['name'],
-                            "members": group['members'],
-                        }
-                    },
-                    to=connected_users[member]
-                )
+        await sio.emit(
+            'member_added',
+            {
+                "group": {
+                    "gid": gid,
+                    "name": group['name'],
+                    "members": group['members'],
+                }
+            },
+            room=group_room(gid)
+        )
 
         return {"status": "ok"}
 
@@ -212,4 +364,10 @@ async def add_member(sid, data):
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools",
+    )
\ No newline at end of file
@@ -1,18 +1,57 @@
-import json
+import base64
+import functools
+import hashlib
+import hmac
+import logging
 import os
+import threading
 import uuid
 from datetime import datetime
 
+import aiosqlite
+import bcrypt
+import orjson
+
+logger = logging.getLogger(__name__)
+
 # --- FS Setup ---
 
 DATA_DIR = "data"
 MSG_DIR = os.path.join(DATA_DIR, "messages")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 GROUPS_FILE = os.path.join(DATA_DIR, "groups.json")
+CHAT_DB = os.path.join(DATA_DIR, "chat.db")
 
 # Ensure directories exist
 os.makedirs(MSG_DIR, exist_ok=True)
 
+# --- In-memory cache ---
+
+# Parsed file contents keyed by path, plus the mtime they were read at.
+# Lookups only stat the file and re-parse it when it changed on disk.
+_CACHE = {}
+_MTIMES = {}
+_LOAD_FAILED = object()  # Sentinel default, so _load_cached can tell a failed load apart
+
+# --- Write buffer ---
+
+# How often the background writer should call flush_writes() and commit_messages(), in seconds
+FLUSH_INTERVAL = 0.02
+
+# JSON file path -> latest encoded snapshot waiting to be written
+_PENDING_SAVES = {}
+# Paths whose cached data is newer than the file, so the cache can't be refreshed from disk
+_DIRTY = set()
+_PENDING_LOCK = threading.Lock()
+
+# Held while a batch is written so two flushes never interleave
+_WRITE_LOCK = threading.Lock()
+
+# --- History paging ---
+
+# Messages returned per fetch_history call unless the client asks for fewer
+HISTORY_PAGE_SIZE = 100
+
 # --- JSON helpers ---
 
 def _load_json(path, default):
@@ -22,15 +61,79 @@ def _load_json(path, default):
     if not os.path.exists(path):
         return default
     try:
-        with open(path, 'r') as f: return json.load(f)
-    except:
+        with open(path, 'rb') as f: return orjson.loads(f.read())
+    except (orjson.JSONDecodeError, OSError) as e:
+        logger.warning("load %s failed: %s", path, e)
         return default
 
 def _save_json(path, data):
     """
-    Save JSON to a file.
+    Update the cache and queue a snapshot of it to be written by flush_writes().
     """
-    with open(path, 'w') as f: json.dump(data, f, indent=2)
+    _CACHE[path] = data
+    snapshot = orjson.dumps(data)  # Compact UTF-8, no indentation or \uXXXX escapes
+    with _PENDING_LOCK:
+        _PENDING_SAVES[path] = snapshot
+        _DIRTY.add(path)
+
+def _load_cached(path, default):
+    """
+    Return the cached JSON for a file, re-reading it only if its mtime changed.
+    """
+    if path in _DIRTY:
+        return _CACHE[path]
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return _CACHE.setdefault(path, default)
+
+    if _MTIMES.get(path) != mtime:
+        data = _load_json(path, _LOAD_FAILED)
+        # Keep serving the last good copy if the file can't be read or parsed.
+        # The mtime is still recorded so a broken file isn't re-parsed until it changes again.
+        if data is not _LOAD_FAILED:
+            _CACHE[path] = data
+        elif path not in _CACHE:
+            # With no good copy, the default would make the file look empty and the
+            # next save would overwrite it, so refuse until it's fixed
+            raise RuntimeError(f"{path} can't be read or parsed, fix or remove it")
+        _MTIMES[path] = mtime
+    return _CACHE.setdefault(path, default)
+
+# --- Disk writer ---
+
+def flush_writes():
+    """
+    Write out everything queued so far. Blocking, so run it off the event loop.
+    """
+    global _PENDING_SAVES
+    with _WRITE_LOCK:
+        with _PENDING_LOCK:
+            saves, _PENDING_SAVES = _PENDING_SAVES, {}
+
+        for path, snapshot in saves.items():
+            # Write a temp file and swap it in, so readers never see a half-written file
+            tmp_path = path + ".tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(snapshot)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+                mtime = os.path.getmtime(path)
+            except OSError as e:
+                # Put it back for the next flush, unless a newer snapshot is already queued
+                logger.warning("save %s failed, will retry: %s", path, e)
+                with _PENDING_LOCK:
+                    _PENDING_SAVES.setdefault(path, snapshot)
+                continue
+
+            with _PENDING_LOCK:
+                _MTIMES[path] = mtime
+                # A newer snapshot may have been queued while we were writing
+                if path not in _PENDING_SAVES:
+                    _DIRTY.discard(path)
 
 # --- Users ---
 
@@ -38,7 +141,7 @@ def get_users():
     """
     Returns the full user dictionary stored in USERS_FILE.
     """
-    return _load_json(USERS_FILE, {})
+    return _load_cached(USERS_FILE, {})
 
 def get_user_list_public():
     """
@@ -46,13 +149,82 @@ def get_user_list_public():
     """
     return list(get_users().keys())
 
+def _prehash(password):
+    """
+    Digests a password to a fixed 44 bytes, since bcrypt rejects inputs over 72 bytes.
+    """
+    return base64.b64encode(hashlib.sha256(password.encode()).digest())
+
+def hash_password(password):
+    """
+    Returns a bcrypt hash of a password. Slow by design, so call it off the event loop.
+    """
+    return bcrypt.hashpw(_prehash(password), bcrypt.gensalt()).decode()
+
+def check_password(password, record):
+    """
+    Checks a password against a user's record. Slow by design, so call it off the event loop.
+    """
+    # Accounts from before hashing store the plaintext password itself
+    if isinstance(record, str):
+        return hmac.compare_digest(record.encode(), password.encode())
+    return bcrypt.checkpw(_prehash(password), record["hash"].encode())
+
+def save_user(username, password_hash):
+    """
+    Stores a user's password hash, registering them if they're new.
+    """
+    users = get_users()
+    users[username] = {"hash": password_hash}
+    _save_json(USERS_FILE, users)
+
 # --- Groups ---
 
+# Membership indexes over the cached groups, so lookups skip list scans:
+# gid -> set of members, and username -> gids they belong to. The gids are dict keys
+# used as an ordered set, so a user's groups keep the order they have in GROUPS_FILE.
+_MEMBERS_INDEX = {}
+_USER_GROUPS = {}
+_INDEXED_GROUPS = None  # The groups dict the indexes were built from
+
+def _index_group(gid, group):
+    """
+    Adds a single group to both membership indexes.
+    """
+    _MEMBERS_INDEX[gid] = set(group['members'])
+    for member in group['members']:
+        _USER_GROUPS.setdefault(member, {})[gid] = None
+
 def get_groups():
     """
     Returns the full group dictionary stored in GROUPS_FILE.
     """
-    return _load_json(GROUPS_FILE, {})
+    global _INDEXED_GROUPS
+    groups = _load_cached(GROUPS_FILE, {})
+
+    # Rebuild the indexes if the file was (re)loaded from disk
+    if groups is not _INDEXED_GROUPS:
+        _MEMBERS_INDEX.clear()
+        _USER_GROUPS.clear()
+        for gid, group in groups.items():
+            _index_group(gid, group)
+        _INDEXED_GROUPS = groups
+
+    return groups
+
+def get_user_groups(username):
+    """
+    Returns the groups a user is a member of, keyed by group ID.
+    """
+    groups = get_groups()
+    return {gid: groups[gid] for gid in _USER_GROUPS.get(username, ())}
+
+def get_group_members(gid):
+    """
+    Returns the member list of a group, or None if the group doesn't exist.
+    """
+    group = get_groups().get(gid)
+    return group['members'] if group else None
 
 def create_group(name, creator):
     """
@@ -66,56 +238,211 @@ def create_group(name, creator):
         "name": name,
         "members": [creator],
     }
+    _index_group(gid, groups[gid])
     _save_json(GROUPS_FILE, groups)
 
     return gid, groups[gid]
 
 def add_member_to_group(gid, username):
     """
-    Adds a user to a group and returns True if successful, False otherwise.
+    Adds a user to a group and returns the updated group, or None if nothing changed.
     """
     groups = get_groups()
+    members = _MEMBERS_INDEX.get(gid)
 
-    if gid in groups and username not in groups[gid]['members']:
+    if members is not None and username not in members:
+        members.add(username)
+        _USER_GROUPS.setdefault(username, {})[gid] = None
         groups[gid]['members'].append(username)
         _save_json(GROUPS_FILE, groups)
-        return True
+        return groups[gid]
     
-    return False
+    return None
 
 # --- Messages ---
 
-def _get_chat_filename(target_type, u1, u2_or_gid):
+# Messages live in SQLite (WAL mode), one row per message, indexed by chat then time
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_key TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    text TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_ts_id ON messages (chat_key, ts, id);
+CREATE TABLE IF NOT EXISTS imported_logs (name TEXT PRIMARY KEY);
+"""
+
+_db = None            # aiosqlite connection, opened by init_db()
+_uncommitted = False  # Whether inserts are waiting for commit_messages()
+
+# Chats whose chat_key stays cached. Bounded, since chat ids come straight from clients.
+CHAT_KEY_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=CHAT_KEY_CACHE_SIZE)
+def _build_chat_key(key):
+    """
+    Builds the chat_key for a gid or an ordered (user, user) pair.
+    """
+    if isinstance(key, tuple):
+        return f"private:{key[0]}:{key[1]}"
+    return f"group:{key}"
+
+def _get_chat_key(target_type, u1, u2_or_gid):
     """
-    Returns the filename for a given chat.
+    Returns the chat_key for a given chat.
     """
     if target_type == "group":
-        return os.path.join(MSG_DIR, f"group_{u2_or_gid}.json")
-    else:
-        # Sort names to ensure alice and bob & bob and alice share the same file
-        participants = sorted([u1, u2_or_gid])
-        return os.path.join(MSG_DIR, f"private_{participants[0]}_{participants[1]}.json")
+        return _build_chat_key(u2_or_gid)
+
+    # Order names to ensure alice and bob & bob and alice share the same chat
+    return _build_chat_key((u1, u2_or_gid) if u1 < u2_or_gid else (u2_or_gid, u1))
+
+def _read_chat_log(path):
+    """
+    Reads a pre-SQLite chat file: a JSON array (.json) or one message per line (.jsonl).
+    Returns None if the file can't be read or parsed.
+    """
+    if path.endswith(".json"):
+        messages = _load_json(path, _LOAD_FAILED)
+        return None if messages is _LOAD_FAILED else messages
+    try:
+        with open(path, 'rb') as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    except (orjson.JSONDecodeError, OSError) as e:
+        logger.warning("load %s failed: %s", path, e)
+        return None
+
+def _split_private_pair(pair):
+    """
+    Splits the "a_b" part of a private chat file name into its two usernames,
+    or returns None if it's ambiguous. Usernames may contain "_" themselves.
+    """
+    splits = [(pair[:i], pair[i + 1:]) for i, c in enumerate(pair) if c == "_"]
+    if len(splits) == 1:
+        return splits[0]
+
+    users = get_users()
+    known = [(u1, u2) for u1, u2 in splits if u1 in users and u2 in users]
+    return known[0] if len(known) == 1 else None
 
-def save_message(target_type, sender, target_id, text):
+async def _import_chat_logs():
     """
-    Save a message to a chat.
+    Copies messages from the old per-chat files into the database, once per file.
     """
-    filepath = _get_chat_filename(target_type, sender, target_id)
-    history = _load_json(filepath, [])
+    async with _db.execute("SELECT name FROM imported_logs") as cursor:
+        imported = {name for (name,) in await cursor.fetchall()}
 
+    for name in sorted(os.listdir(MSG_DIR)):
+        stem, ext = os.path.splitext(name)
+        if ext not in (".json", ".jsonl") or name in imported:
+            continue
+
+        if stem.startswith("group_"):
+            chat_key = _get_chat_key("group", None, stem[len("group_"):])
+        else:
+            participants = _split_private_pair(stem[len("private_"):])
+            if participants is None:
+                logger.warning("skipping %s: can't tell which users it belongs to", name)
+                continue
+            chat_key = _get_chat_key("private", *participants)
+
+        # Files that fail to load aren't recorded, so they're retried on the next start
+        messages = _read_chat_log(os.path.join(MSG_DIR, name))
+        if messages is None:
+            continue
+
+        rows = [
+            (chat_key, msg["from"], msg["text"], msg["timestamp"])
+            for msg in messages
+        ]
+        await _db.executemany(
+            "INSERT INTO messages (chat_key, sender, text, ts) VALUES (?, ?, ?, ?)", rows
+        )
+        await _db.execute("INSERT INTO imported_logs (name) VALUES (?)", (name,))
+
+async def init_db():
+    """
+    Opens the message database, creating it and importing old chat files if needed.
+    """
+    global _db
+    # Fail at startup rather than on the first login if either JSON store is unreadable
+    get_users()
+    get_groups()
+
+    _db = await aiosqlite.connect(CHAT_DB)
+    await _db.execute("PRAGMA journal_mode=WAL")
+    await _db.execute("PRAGMA synchronous=NORMAL")
+    await _db.executescript(_SCHEMA)
+    await _import_chat_logs()
+    await _db.commit()
+
+async def close_db():
+    """
+    Commits anything outstanding and closes the message database.
+    """
+    await commit_messages()
+    await _db.close()
+
+async def save_message(target_type, sender, target_id, text):
+    """
+    Save a message to a chat. It's committed by the next commit_messages() call.
+    """
+    global _uncommitted
     msg = {
         "from": sender,
         "text": text,
         "timestamp": datetime.now().timestamp(),
     }
 
-    history.append(msg)
-    _save_json(filepath, history)
+    await _db.execute(
+        "INSERT INTO messages (chat_key, sender, text, ts) VALUES (?, ?, ?, ?)",
+        (_get_chat_key(target_type, sender, target_id), sender, text, msg["timestamp"])
+    )
+    _uncommitted = True
     return msg
 
-def load_history(target_type, username, target_id):
+async def commit_messages():
+    """
+    Commits every message saved since the last call in a single transaction.
+    """
+    global _uncommitted
+    if _uncommitted:
+        _uncommitted = False
+        try:
+            await _db.commit()
+        except Exception:
+            # The rows are still in the open transaction, so retry on the next call
+            _uncommitted = True
+            raise
+
+async def load_history(target_type, username, target_id, limit=HISTORY_PAGE_SIZE, before=None):
     """
-    Load all messages from a chat.
+    Load the latest `limit` messages of a chat, or the ones just before the
+    `before` cursor, a (ts, id) pair from a previous page.
     """
-    filepath = _get_chat_filename(target_type, username, target_id)
-    return _load_json(filepath, [])
\ No newline at end of file
+    chat_key = _get_chat_key(target_type, username, target_id)
+
+    # Messages can share a timestamp, so pages are ordered and cut by (ts, id).
+    # Fetch one extra row to tell whether there's an older page.
+    if before is None:
+        query = "SELECT id, sender, text, ts FROM messages WHERE chat_key = ? ORDER BY ts DESC, id DESC LIMIT ?"
+        params = (chat_key, limit + 1)
+    else:
+        query = "SELECT id, sender, text, ts FROM messages WHERE chat_key = ? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?"
+        params = (chat_key, before[0], before[1], limit + 1)
+
+    async with _db.execute(query, params) as cursor:
+        rows = await cursor.fetchall()
+
+    page = rows[:limit]
+    return {
+        "messages": [
+            {"from": sender, "text": text, "timestamp": ts}
+            for _, sender, text, ts in reversed(page)
+        ],
+        "has_more": len(rows) > limit,
+        # Pass this back as `before` to get the next older page
+        "cursor": {"ts": page[-1][3], "id": page[-1][0]} if page else None,
+    }